@@ -1,23 +1,74 @@
-# ignore warnings from sqlalchemy and pandas
-
 from __future__ import annotations
 
 import argparse
+import functools
 import os
 import re
 import shutil
 import subprocess
+import sys
+import tempfile
+import time
 import warnings
-from hashlib import sha1
+from collections import ChainMap
+from hashlib import blake2b
 from pathlib import Path
+from types import MappingProxyType
+from typing import Mapping, NamedTuple
+
 
-import pandas as pd
-from sqlalchemy.engine import create_engine
+def _env_int(name: str, default: int) -> int:
+    """Read a positive int from the environment, default if unset or bad
 
-warnings.filterwarnings("ignore")
+    A bad value only warns, so it can't break the import and with it
+    even --help.
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        parsed = int(value)
+    except ValueError:
+        parsed = 0
+    if parsed > 0:
+        return parsed
+    print(
+        f"Warning: {name}={value!r} is not a positive integer, "
+        f"using {default}",
+        file=sys.stderr,
+    )
+    return default
 
 
 DRUIDQ_URL = os.environ.get("DRUIDQ_URL", "druid://localhost:8887/")
+DRUIDQ_CHUNKSIZE = _env_int("DRUIDQ_CHUNKSIZE", 50000)
+DRUIDQ_CACHE_MAX_BYTES = _env_int("DRUIDQ_CACHE_MAX_BYTES", 10 * 1024**3)
+
+_FMT_KEYS_RE = re.compile(r"\{\{[^{}]+\}\}")
+# Any comment line mentioning @param / @eval / @eval-file, with its newline
+_ANNOTATION_LINE_RE = re.compile(
+    r"^[^\S\n]*--[^\n]*@(?:param|eval)[^\n]*(?:\n|$)", re.MULTILINE
+)
+_CACHE_DIR = "/tmp/druidq"
+_HASH_CHUNK_CHARS = 64 * 1024
+# Temp files from cache writes older than this were left by a killed run
+_STALE_TMP_SECONDS = 24 * 3600
+_SQL_KEYWORDS = frozenset(
+    {
+        "SELECT",
+        "WITH",
+        "INSERT",
+        "UPDATE",
+        "DELETE",
+        "CREATE",
+        "ALTER",
+        "DROP",
+        "EXPLAIN",
+    }
+)
+
+# Cache eviction runs at most once per process
+_cache_evicted = False
 
 
 def printer(*args, quiet=False, **kwargs):
@@ -25,10 +76,21 @@ def printer(*args, quiet=False, **kwargs):
         print(*args, **kwargs)
 
 
-def find_fmt_keys(s: str) -> list[str] | None:
-    pattern = r"{{[^}]+}}"
-    matches = re.findall(pattern, s)
-    return matches
+def find_fmt_keys(s: str) -> list[str]:
+    """Find {{key}} placeholders in s, braces included"""
+    return _FMT_KEYS_RE.findall(s)
+
+
+def apply_params(code: str, params: dict[str, str] | None) -> str:
+    """Replace {{key}} placeholders in code with values from params
+
+    Placeholders without a matching param are left untouched.
+    """
+    if not params or "{{" not in code:
+        return code
+    return _FMT_KEYS_RE.sub(
+        lambda m: params.get(m.group(0)[2:-2], m.group(0)), code
+    )
 
 
 def truncate_query(query: str, max_len: int = 50) -> str:
@@ -48,6 +110,122 @@ def truncate_query(query: str, max_len: int = 50) -> str:
     return cleaned[:max_len] + "..."
 
 
+def _parse_sql_header(
+    query: str,
+) -> tuple[str, dict[str, str] | None, str | None, str | None]:
+    """Parse @param / @eval / @eval-file annotations in a single pass
+
+    Annotation lines are removed from the returned SQL so they don't
+    conflict with {{}} formatting.
+
+    Returns:
+        tuple: (cleaned_sql, params, eval_inline, eval_file)
+    """
+    # Cheap substring test before scanning every line
+    if "@param" not in query and "@eval" not in query:
+        return query, None, None, None
+
+    params = {}
+    inline_code = None
+    file_path = None
+    kept = []
+    pos = 0
+
+    # Find annotation lines with one regex scan over the whole text, then
+    # parse each of them individually
+    for m in _ANNOTATION_LINE_RE.finditer(query):
+        kept.append(query[pos : m.start()])
+        pos = m.end()
+
+        # The annotation grammar is simple enough for plain string splits:
+        # -- @<name> <value>
+        parts = m.group().strip()[2:].split(None, 1)
+        if len(parts) < 2:
+            continue
+        name, value = parts
+
+        # Handle -- @param key value
+        if name == "@param":
+            key_value = value.split(None, 1)
+            if len(key_value) == 2:
+                params[key_value[0]] = key_value[1]
+
+        # Handle -- @eval-file path/to/file.py
+        elif name == "@eval-file":
+            file_path = value.strip('"').strip("'")
+
+        # Handle -- @eval code here
+        elif name == "@eval":
+            inline_code = value
+
+    kept.append(query[pos:])
+    out = "".join(kept)
+    # A removed last line leaves the newline of the line before it behind
+    if pos == len(query) and out.endswith("\n") and query[-1:] != "\n":
+        out = out[:-1]
+
+    return out, params or None, inline_code, file_path
+
+
+class ParsedQuery(NamedTuple):
+    """Parsed structure of a raw SQL text, before any substitution"""
+
+    sql: str
+    params: Mapping[str, str] | None
+    eval_inline: str | None
+    eval_file: str | None
+    # sql split around its {{key}} placeholders, so that
+    # sql == fragments[0] + {{keys[0]}} + fragments[1] + ...
+    fragments: tuple[str, ...]
+    keys: tuple[str, ...]
+
+
+def _split_placeholders(sql: str) -> tuple[tuple[str, ...], tuple[str, ...]]:
+    """Split sql into the static fragments between placeholders and keys"""
+    fragments = []
+    keys = []
+    pos = 0
+    for m in _FMT_KEYS_RE.finditer(sql):
+        fragments.append(sql[pos : m.start()])
+        keys.append(sys.intern(m.group()[2:-2]))
+        pos = m.end()
+    fragments.append(sql[pos:])
+    return tuple(fragments), tuple(keys)
+
+
+def _render(
+    fragments: tuple[str, ...], keys: tuple[str, ...], values: dict[str, str]
+) -> str:
+    """Join fragments with the value of each placeholder in between"""
+    parts = [fragments[0]]
+    append = parts.append
+    for key, fragment in zip(keys, fragments[1:]):
+        append(values[key])
+        append(fragment)
+    return "".join(parts)
+
+
+@functools.lru_cache(maxsize=512)
+def _parse_query_structure(query: str) -> ParsedQuery:
+    """Parse annotations and placeholders, memoized for repeated queries
+
+    The result is shared between calls, so params is a read-only mapping
+    and keys are interned to match placeholder keys by identity.
+    """
+    sql, params, eval_inline, eval_file = _parse_sql_header(query)
+    fragments, keys = (sql,), ()
+    if "{{" in sql:
+        fragments, keys = _split_placeholders(sql)
+    frozen_params = None
+    if params:
+        frozen_params = MappingProxyType(
+            {sys.intern(k): v for k, v in params.items()}
+        )
+    return ParsedQuery(
+        sql, frozen_params, eval_inline, eval_file, fragments, keys
+    )
+
+
 def extract_params_from_query(query: str) -> dict[str, str] | None:
     """Extract params from -- @param key value comments in SQL query
 
@@ -61,17 +239,7 @@ def extract_params_from_query(query: str) -> dict[str, str] | None:
     Returns:
         dict[str, str] | None: Dictionary of parameters or None if not found
     """
-    params = {}
-    pattern = r"--\s*@param\s+(\S+)\s+(.+)"
-
-    for line in query.split("\n"):
-        match = re.match(pattern, line.strip())
-        if match:
-            key = match.group(1)
-            value = match.group(2).strip()
-            params[key] = value
-
-    return params if params else None
+    return _parse_sql_header(query)[1]
 
 
 def extract_eval_from_query(query: str) -> tuple[str | None, str | None]:
@@ -84,26 +252,7 @@ def extract_eval_from_query(query: str) -> tuple[str | None, str | None]:
     Returns:
         tuple[str | None, str | None]: (inline_code, file_path)
     """
-    inline_code = None
-    file_path = None
-
-    pattern_eval_file = r"--\s*@eval-file\s+(.+)"
-    pattern_eval = r"--\s*@eval\s+(.+)"
-
-    for line in query.split("\n"):
-        line = line.strip()
-
-        # Handle -- @eval-file path/to/file.py
-        match = re.match(pattern_eval_file, line)
-        if match:
-            file_path = match.group(1).strip().strip('"').strip("'")
-
-        # Handle -- @eval code here
-        else:
-            match = re.match(pattern_eval, line)
-            if match:
-                inline_code = match.group(1).strip()
-
+    _, _, inline_code, file_path = _parse_sql_header(query)
     return inline_code, file_path
 
 
@@ -116,72 +265,50 @@ def get_query(args):
     # Check if explicit file flag is set
     if hasattr(args, "file") and args.file:
         # Explicit file mode - always read from file
-        with open(query_in, "r") as f:
-            out = f.read()
-            sql_file_path = query_in
-            # Use just the filename (not full path) for notification
-            query_source_filename = os.path.basename(query_in)
+        out = Path(query_in).read_text(encoding="utf-8")
+        sql_file_path = query_in
+        # Use just the filename (not full path) for notification
+        query_source_filename = os.path.basename(query_in)
     else:
         # Without -f flag, treat as SQL string only
-        # Check if user accidentally passed a file path
-        if os.path.exists(query_in) or query_in.endswith(".sql"):
+        # Check if user accidentally passed a file path, skipping the stat
+        # when the string is clearly SQL. Only look at the first word.
+        words = query_in.lstrip()[:10].split(None, 1)
+        first = words[0].upper() if words else ""
+        is_query = "\n" in query_in or first in _SQL_KEYWORDS
+        if query_in.endswith(".sql") or (
+            not is_query and os.path.exists(query_in)
+        ):
             raise ValueError(
                 f"'{query_in}' looks like a file path. "
                 f"Use -f flag to read from file: druidq -f {query_in}"
             )
         out = query_in
 
-    # Extract params from comment first
-    params = extract_params_from_query(out)
-
-    # Extract eval code/file from comment first (before formatting)
-    eval_inline, eval_file = extract_eval_from_query(out)
-
-    # Remove special comments before formatting to avoid conflicts with {{}}
-    lines = []
-    for line in out.split("\n"):
-        line_stripped = line.strip()
-        # Skip @param, @eval, @eval-file comment lines
-        if line_stripped.startswith("--") and (
-            "@param" in line_stripped
-            or "@eval-file" in line_stripped
-            or "@eval" in line_stripped
-        ):
-            continue
-        lines.append(line)
-    out = "\n".join(lines)
+    # Extract params and eval code/file, and remove the annotation lines
+    # before formatting to avoid conflicts with {{}}
+    parsed = _parse_query_structure(out)
+    out = parsed.sql
+    params = dict(parsed.params) if parsed.params else None
+    eval_inline = parsed.eval_inline
+    eval_file = parsed.eval_file
 
     # format {{{
-    fmt_keys = find_fmt_keys(out)
-    if fmt_keys:
-        fmt_values = {}
-        for key in fmt_keys:
-            # Remove {{ and }} from key
-            k = key[2:-2]
-            # Priority: params from comment > environment variables
-            if params and k in params:
-                fmt_values[k] = params[k]
-            else:
-                fmt_values[k] = os.environ[k]
+    if parsed.keys:
+        # Priority: params from comment > environment variables
+        lookup = ChainMap(params or {}, os.environ)
+        # Flatten only the keys used, each resolved once
+        fmt_values = {k: lookup[k] for k in dict.fromkeys(parsed.keys)}
 
-        # Simple string replacement instead of format()
+        # Join the cached fragments instead of format() or a regex pass
         # to avoid issues with { } in SQL
-        formatted_out = out
-        for key in fmt_keys:
-            k = key[2:-2]
-            formatted_out = formatted_out.replace(
-                f"{{{{{k}}}}}", fmt_values[k]
-            )
-
-        out = formatted_out
+        out = _render(parsed.fragments, parsed.keys, fmt_values)
     # }}}
 
     # Apply params to eval code if present
-    if params:
-        if eval_inline:
-            for key, value in params.items():
-                eval_inline = eval_inline.replace(f"{{{{{key}}}}}", value)
-        # Note: eval_file content will be formatted later when read
+    # Note: eval_file content will be formatted later when read
+    if eval_inline:
+        eval_inline = apply_params(eval_inline, params)
 
     # Resolve relative eval paths relative to SQL file location
     if eval_file and sql_file_path and not os.path.isabs(eval_file):
@@ -299,24 +426,60 @@ def get_eval_df_from_file(
     eval_file: str, params: dict[str, str] | None = None
 ) -> str:
     """Read eval code from file and apply params if provided"""
-    with open(eval_file, "r") as f:
-        code = f.read()
+    code = Path(eval_file).read_text(encoding="utf-8")
 
     # Apply params to eval code if present
-    if params:
-        for key, value in params.items():
-            code = code.replace(f"{{{{{key}}}}}", value)
+    return apply_params(code, params)
 
-    return code
 
+@functools.lru_cache(maxsize=64)
+def _compile_eval(src: str):
+    """Compile eval code once per source string"""
+    return compile(src, "<druidq-eval>", "exec")
 
-def get_temp_file(query):
-    qhash = sha1(query.encode()).hexdigest()
-    temp_file = Path(f"/tmp/druidq/{qhash}.parquet")
-    if not temp_file.parent.exists():
-        temp_file.parent.mkdir(parents=True, exist_ok=True)
 
-    return temp_file
+@functools.lru_cache(maxsize=1024)
+def get_temp_file(query: str) -> Path:
+    # Encode in slices so huge queries are never copied to bytes at once,
+    # the digest is the same as hashing query.encode() in one go
+    h = blake2b(digest_size=20)
+    for i in range(0, len(query), _HASH_CHUNK_CHARS):
+        h.update(query[i : i + _HASH_CHUNK_CHARS].encode())
+    return Path(f"{_CACHE_DIR}/{h.hexdigest()}.parquet")
+
+
+def _evict_cache(cache_dir: Path, max_bytes: int) -> None:
+    """Remove least recently used parquet files until under max_bytes
+
+    Temp files left behind by interrupted cache writes are removed too once
+    they are older than _STALE_TMP_SECONDS, younger ones may still be in
+    use by a concurrent run.
+    """
+    stale_before = time.time() - _STALE_TMP_SECONDS
+    for path in cache_dir.glob("*.parquet.tmp"):
+        try:
+            if path.stat().st_mtime < stale_before:
+                path.unlink()
+        except OSError:
+            continue
+
+    entries = []
+    for path in cache_dir.glob("*.parquet"):
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        entries.append((st.st_atime, st.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+        except OSError:
+            continue
+        total -= size
 
 
 def send_notification(
@@ -355,28 +518,142 @@ def send_notification(
         printer(f"Warning: Failed to send notification: {e}", quiet=False)
 
 
-def execute(query, engine=None, no_cache=False, quiet=True):
-    if engine is None:
-        engine = create_engine(DRUIDQ_URL)
+@functools.lru_cache(maxsize=4)
+def _get_engine(url: str):
+    """Create the sqlalchemy engine for url once and reuse it"""
+    from sqlalchemy.engine import create_engine
 
-    if no_cache:
-        return pd.read_sql(query, engine.raw_connection())
+    # ignore deprecation warnings from the pydruid dialect
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return create_engine(url)
 
-    # cache {{
-    temp_file = get_temp_file(query)
-    if temp_file.exists():
-        printer(f"Loading cache: {temp_file}", quiet=quiet)
-        return pd.read_parquet(temp_file)
-    # }}
 
-    df = pd.read_sql(query, engine.raw_connection())
+def read_sql(query, engine):
+    """Fetch query results in chunks of DRUIDQ_CHUNKSIZE rows
+
+    Only one chunk of raw DBAPI row tuples is held in memory at a time
+    instead of the whole result set, the DataFrame chunks themselves are
+    kept until they are concatenated.
+    """
+    # pandas is slow to import, defer it until a query actually runs so
+    # --help, --dry-run and argument errors stay fast
+    import pandas as pd
+
+    # ignore warnings from pandas about the raw DBAPI connection
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        conn = engine.raw_connection()
+        try:
+            frames = list(pd.read_sql(query, conn, chunksize=DRUIDQ_CHUNKSIZE))
+        finally:
+            # Return the connection to the engine's pool, so the cached
+            # engine reuses it on the next query
+            conn.close()
+    if not frames:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0]
+    result = pd.concat(frames, ignore_index=True)
+    # Drop the chunks before re-inferring so they don't add to peak memory
+    frames.clear()
+    # pandas infers dtypes per chunk, e.g. a numeric column that is all NULL
+    # within one chunk comes back as object, re-infer those columns on the
+    # whole result to get the same dtypes as a single read. Only object
+    # columns, infer_objects() on the frame copies every block
+    obj_cols = [
+        col
+        for col, dtype in result.dtypes.items()
+        if pd.api.types.is_object_dtype(dtype)
+    ]
+    if not obj_cols:
+        return result
+    if not result.columns.is_unique:
+        return result.infer_objects()
+    for col in obj_cols:
+        result[col] = result[col].infer_objects()
+    return result
+
+
+def execute(query, engine=None, no_cache=False, quiet=True, as_arrow=False):
+    """Run query against Druid, using the parquet cache unless no_cache
+
+    If as_arrow is True a cache hit returns the cached pyarrow.Table as is,
+    skipping the conversion to a pandas DataFrame.
+    """
+    if not no_cache:
+        # cache {{
+        temp_file = get_temp_file(query)
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # Open directly instead of checking exists() first, so there is no
+        # window for the file to vanish in between. Passing the open map
+        # also keeps read_table from stat-ing the path again
+        try:
+            with pa.memory_map(str(temp_file)) as f:
+                table = pq.read_table(f)
+        except FileNotFoundError:
+            pass
+        else:
+            printer(f"Loading cache: {temp_file}", quiet=quiet)
+            # Mark as recently used for cache eviction
+            try:
+                os.utime(temp_file)
+            except OSError:
+                pass
+            if as_arrow:
+                return table
+            # Free arrow buffers column by column while converting, instead
+            # of holding both copies of the data until the end. No
+            # split_blocks, its zero-copy columns are read-only and break
+            # eval code that edits df in place
+            return table.to_pandas(self_destruct=True)
+        # }}
+
+    if engine is None:
+        engine = _get_engine(DRUIDQ_URL)
+
+    df = read_sql(query, engine)
+
+    if no_cache:
+        return df
 
     # cache {{
     printer(f"Saving cache: {temp_file}", quiet=quiet)
+    # Write to a sibling file and rename it so an interrupted write never
+    # leaves a truncated parquet behind. The name is unique per writer so
+    # concurrent runs of the same query don't write to the same file.
+    tmp = None
     try:
-        df.to_parquet(temp_file)
+        temp_file.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(
+            dir=temp_file.parent,
+            prefix=f"{temp_file.stem}.",
+            suffix=".parquet.tmp",
+        )
+        os.close(fd)
+        tmp = Path(tmp_name)
+        df.to_parquet(
+            tmp,
+            engine="pyarrow",
+            compression="zstd",
+            compression_level=1,
+        )
+        os.replace(tmp, temp_file)
+        tmp = None
     except Exception as e:
         printer(f"Error saving cache: {e}", quiet=quiet)
+    finally:
+        # Also on KeyboardInterrupt, every write has its own temp name so
+        # nothing else would ever reuse or remove it
+        if tmp is not None:
+            tmp.unlink(missing_ok=True)
+
+    global _cache_evicted
+    if not _cache_evicted:
+        _cache_evicted = True
+        _evict_cache(temp_file.parent, DRUIDQ_CACHE_MAX_BYTES)
     # }}
 
     return df
@@ -416,7 +693,20 @@ def app():
 
     # Execute query with optional timing
     start_time = time.time() if (args.timing or args.noti) else 0.0
-    df = execute(query=query, no_cache=args.no_cache, quiet=cache_quiet)
+    # pandas is only needed to print, export as json/csv or eval the result,
+    # otherwise a cache hit can skip the arrow -> pandas conversion
+    has_eval = bool(
+        args.eval or args.eval_file or auto_eval_inline or auto_eval_file
+    )
+    as_arrow = not has_eval and (
+        args.output == "parquet" or (not args.output and not show_output)
+    )
+    df = execute(
+        query=query,
+        no_cache=args.no_cache,
+        quiet=cache_quiet,
+        as_arrow=as_arrow,
+    )
     elapsed = 0.0
     if args.timing or args.noti:
         elapsed = time.time() - start_time
@@ -432,7 +722,14 @@ def app():
         elif args.output == "parquet":
             # For parquet, need to write to file
             output_file = "output.parquet"
-            df.to_parquet(output_file)
+            import pyarrow as pa
+
+            if isinstance(df, pa.Table):
+                import pyarrow.parquet as pq
+
+                pq.write_table(df, output_file)
+            else:
+                df.to_parquet(output_file)
             print(f"Exported to {output_file}")
     elif show_output:
         print(df)
@@ -445,9 +742,7 @@ def app():
         # Inline code from CLI flag
         eval_code = args.eval
         # Apply params if present
-        if params:
-            for key, value in params.items():
-                eval_code = eval_code.replace(f"{{{{{key}}}}}", value)
+        eval_code = apply_params(eval_code, params)
     elif args.eval_file:
         # File from CLI flag
         eval_code = get_eval_df_from_file(args.eval_file, params)
@@ -462,7 +757,11 @@ def app():
         if show_eval_input:
             print(f"\nIn[eval]:\n{eval_code}")
 
-        exec(eval_code, globals(), locals())
+        # Expose pandas to eval code as `pd`, in globals so that functions,
+        # lambdas and comprehensions defined in eval code can see it too
+        import pandas as pd
+
+        exec(_compile_eval(eval_code), {**globals(), "pd": pd}, locals())
 
     # Send notification if requested
     if args.noti:
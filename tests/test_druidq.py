@@ -1,17 +1,48 @@
-from unittest.mock import Mock, mock_open, patch
+import os
+import sqlite3
+from hashlib import blake2b
+from unittest.mock import Mock, patch
 
 import pandas as pd
 import pytest
 
 from src.druidq import (
+    _compile_eval,
+    _env_int,
+    _evict_cache,
+    _get_engine,
+    _parse_query_structure,
+    _parse_sql_header,
+    app,
+    apply_params,
     execute,
     extract_params_from_query,
     find_fmt_keys,
     get_query,
     get_temp_file,
+    read_sql,
 )
 
 
+class TestEnvInt:
+    def test_unset_uses_default(self, monkeypatch):
+        monkeypatch.delenv("DRUIDQ_TEST_INT", raising=False)
+        assert _env_int("DRUIDQ_TEST_INT", 5) == 5
+
+    def test_valid_value(self, monkeypatch):
+        monkeypatch.setenv("DRUIDQ_TEST_INT", "42")
+        assert _env_int("DRUIDQ_TEST_INT", 5) == 42
+
+    @pytest.mark.parametrize("value", ["abc", "", "0", "-1", "1.5"])
+    def test_bad_value_warns_and_uses_default(
+        self, monkeypatch, capsys, value
+    ):
+        monkeypatch.setenv("DRUIDQ_TEST_INT", value)
+
+        assert _env_int("DRUIDQ_TEST_INT", 5) == 5
+        assert "DRUIDQ_TEST_INT" in capsys.readouterr().err
+
+
 class TestFindFmtKeys:
     def test_find_single_key(self):
         result = find_fmt_keys("SELECT * FROM {{table}}")
@@ -30,6 +61,23 @@ class TestFindFmtKeys:
         assert result == []
 
 
+class TestApplyParams:
+    def test_replaces_known_params(self):
+        result = apply_params("print('{{a}}', '{{b}}')", {"a": "1", "b": "2"})
+        assert result == "print('1', '2')"
+
+    def test_unknown_placeholders_untouched(self):
+        result = apply_params("print('{{a}}', '{{other}}')", {"a": "1"})
+        assert result == "print('1', '{{other}}')"
+
+    def test_no_params(self):
+        assert apply_params("print('{{a}}')", None) == "print('{{a}}')"
+
+    def test_nested_braces(self):
+        result = apply_params("f'{{{a}}}'", {"a": "x"})
+        assert result == "f'{x}'"
+
+
 class TestGetQuery:
     def test_detect_sql_query_select(self):
         args = Mock(query="SELECT * FROM table", file=False)
@@ -59,8 +107,8 @@ class TestGetQuery:
         assert params is None
         assert query_source == "SELECT * FROM table WHERE id = 1"
 
-    @patch("builtins.open", mock_open(read_data="SELECT * FROM file"))
-    def test_read_from_file(self):
+    @patch("pathlib.Path.read_text", return_value="SELECT * FROM file")
+    def test_read_from_file(self, mock_read_text):
         args = Mock(query="query.sql", file=True)
         query, eval_inline, eval_file, params, query_source = get_query(args)
         assert query == "SELECT * FROM file"
@@ -69,6 +117,20 @@ class TestGetQuery:
         assert params is None
         assert query_source == "query.sql"
 
+    @patch("os.path.exists")
+    def test_detect_sql_query_skips_path_check(self, mock_exists):
+        args = Mock(query="  select * from events", file=False)
+        query, _, _, _, _ = get_query(args)
+        assert query == "  select * from events"
+        mock_exists.assert_not_called()
+
+    @patch("os.path.exists", return_value=True)
+    def test_keyword_prefixed_path_still_checked(self, mock_exists):
+        args = Mock(query="selected_rows", file=False)
+        with pytest.raises(ValueError):
+            get_query(args)
+        mock_exists.assert_called_once_with("selected_rows")
+
     def test_sql_file_without_flag_raises_error(self):
         # Test that passing a .sql file without -f flag raises helpful error
         args = Mock(query="query.sql", file=False)
@@ -88,8 +150,17 @@ class TestGetQuery:
         # query_source uses the formatted query (after variable substitution)
         assert query_source == "SELECT * FROM users"
 
-    @patch("builtins.open", mock_open(read_data="SELECT * FROM explicit"))
-    def test_explicit_file_flag(self):
+    @patch.dict("os.environ", {"col": "id", "table_name": "users"})
+    def test_format_repeated_keys(self):
+        args = Mock(
+            query="SELECT {{col}} FROM {{table_name}} ORDER BY {{col}}",
+            file=False,
+        )
+        query, _, _, _, _ = get_query(args)
+        assert query == "SELECT id FROM users ORDER BY id"
+
+    @patch("pathlib.Path.read_text", return_value="SELECT * FROM explicit")
+    def test_explicit_file_flag(self, mock_read_text):
         args = Mock(query="query.sql", file=True)
         query, eval_inline, eval_file, params, query_source = get_query(args)
         assert query == "SELECT * FROM explicit"
@@ -98,8 +169,8 @@ class TestGetQuery:
         assert params is None
         assert query_source == "query.sql"
 
-    @patch("builtins.open", side_effect=FileNotFoundError)
-    def test_explicit_file_flag_raises_on_missing_file(self, mock_file):
+    @patch("pathlib.Path.read_text", side_effect=FileNotFoundError)
+    def test_explicit_file_flag_raises_on_missing_file(self, mock_read_text):
         args = Mock(query="missing.sql", file=True)
         try:
             get_query(args)
@@ -148,6 +219,52 @@ SELECT * FROM table"""
         assert result == {"token": "abc123"}
 
 
+class TestParseSqlHeader:
+    def test_single_pass_extracts_and_strips(self):
+        query = """-- @param a 1
+-- @eval print(df)
+-- @eval-file 'script.py'
+-- Regular comment
+SELECT {{a}}"""
+        sql, params, eval_inline, eval_file = _parse_sql_header(query)
+        assert sql == "-- Regular comment\nSELECT {{a}}"
+        assert params == {"a": "1"}
+        assert eval_inline == "print(df)"
+        assert eval_file == "script.py"
+
+    def test_no_annotations(self):
+        query = "SELECT *\nFROM table"
+        assert _parse_sql_header(query) == (query, None, None, None)
+
+    def test_strips_indented_and_trailing_annotations(self):
+        query = "SELECT 1\n  -- @param a 1\nFROM t\n-- @eval print(df)"
+        sql, params, eval_inline, _ = _parse_sql_header(query)
+        assert sql == "SELECT 1\nFROM t"
+        assert params == {"a": "1"}
+        assert eval_inline == "print(df)"
+
+    def test_cached_parse_reused(self):
+        query = "-- @param cached 1\nSELECT {{cached}}"
+        assert _parse_query_structure(query) is _parse_query_structure(query)
+
+    def test_query_structure_placeholders(self):
+        query = "-- @param a 1\nSELECT {{a}}, {{b}} FROM {{a}}"
+        parsed = _parse_query_structure(query)
+        assert parsed.sql == "SELECT {{a}}, {{b}} FROM {{a}}"
+        assert parsed.params == {"a": "1"}
+        with pytest.raises(TypeError):
+            parsed.params["a"] = "2"
+        assert parsed.fragments == ("SELECT ", ", ", " FROM ", "")
+        assert parsed.keys == ("a", "b", "a")
+
+    def test_get_query_returns_private_params_copy(self):
+        query_str = "-- @param key value\nSELECT '{{key}}'"
+        _, _, _, params, _ = get_query(Mock(query=query_str, file=False))
+        params["key"] = "mutated"
+        _, _, _, params, _ = get_query(Mock(query=query_str, file=False))
+        assert params == {"key": "value"}
+
+
 class TestParamsInQuery:
     def test_params_in_query(self):
         query_str = "-- @param token 1111-1111-01\nSELECT * FROM table WHERE publisher_token = '{{token}}'"
@@ -184,6 +301,18 @@ class TestParamsInQuery:
         assert query_source is not None
 
 
+class TestCompileEval:
+    def test_compiled_code_is_reused(self):
+        code = _compile_eval("result = len(df)")
+        assert code is _compile_eval("result = len(df)")
+        assert code.co_filename == "<druidq-eval>"
+
+    def test_compiled_code_runs(self):
+        namespace = {"df": [1, 2, 3]}
+        exec(_compile_eval("result = len(df)"), namespace)
+        assert namespace["result"] == 3
+
+
 class TestGetTempFile:
     def test_temp_file_path(self):
         query = "SELECT * FROM table"
@@ -201,49 +330,273 @@ class TestGetTempFile:
         result2 = get_temp_file(query)
         assert result1 == result2
 
+    def test_long_query_hash_matches_single_pass(self):
+        query = "SELECT 'é'" * 20000
+        expected = blake2b(query.encode(), digest_size=20).hexdigest()
+        assert get_temp_file(query).stem == expected
+
+    def test_same_query_memoized(self):
+        assert get_temp_file("SELECT 3") is get_temp_file("SELECT 3")
+
     def test_different_query_different_hash(self):
         result1 = get_temp_file("SELECT 1")
         result2 = get_temp_file("SELECT 2")
         assert result1 != result2
 
 
+class TestEvictCache:
+    def test_evicts_least_recently_used(self, tmp_path):
+        for atime, name in enumerate(["old", "mid", "new"]):
+            path = tmp_path / f"{name}.parquet"
+            path.write_bytes(b"x" * 10)
+            os.utime(path, (atime, atime))
+
+        _evict_cache(tmp_path, max_bytes=20)
+
+        remaining = sorted(p.name for p in tmp_path.glob("*.parquet"))
+        assert remaining == ["mid.parquet", "new.parquet"]
+
+    def test_under_limit_keeps_everything(self, tmp_path):
+        (tmp_path / "a.parquet").write_bytes(b"x" * 10)
+
+        _evict_cache(tmp_path, max_bytes=100)
+
+        assert (tmp_path / "a.parquet").exists()
+
+    def test_removes_stale_temp_files(self, tmp_path):
+        stale = tmp_path / "a.1234.parquet.tmp"
+        fresh = tmp_path / "b.5678.parquet.tmp"
+        stale.write_bytes(b"x")
+        fresh.write_bytes(b"x")
+        os.utime(stale, (0, 0))
+
+        _evict_cache(tmp_path, max_bytes=100)
+
+        assert not stale.exists()
+        assert fresh.exists()
+
+
 class TestExecute:
-    @patch("src.druidq.pd.read_sql")
-    @patch("src.druidq.create_engine")
+    def setup_method(self):
+        _get_engine.cache_clear()
+
+    @patch("pandas.read_sql")
+    @patch("sqlalchemy.engine.create_engine")
     def test_execute_no_cache(self, mock_engine, mock_read_sql):
         mock_df = pd.DataFrame({"id": [1, 2], "name": ["a", "b"]})
-        mock_read_sql.return_value = mock_df
+        mock_read_sql.return_value = iter([mock_df])
 
         result = execute("SELECT * FROM table", no_cache=True)
 
         assert result.equals(mock_df)
         mock_read_sql.assert_called_once()
 
-    @patch("src.druidq.pd.read_parquet")
-    @patch("src.druidq.Path.exists")
-    def test_execute_with_cache_hit(self, mock_exists, mock_read_parquet):
-        mock_exists.return_value = True
+    @patch("pyarrow.parquet.read_table")
+    @patch("pyarrow.memory_map")
+    def test_execute_with_cache_hit(self, mock_memory_map, mock_read_table):
         mock_df = pd.DataFrame({"id": [1], "name": ["cached"]})
-        mock_read_parquet.return_value = mock_df
+        mock_read_table.return_value.to_pandas.return_value = mock_df
 
         result = execute("SELECT * FROM table", no_cache=False)
 
         assert result.equals(mock_df)
-        mock_read_parquet.assert_called_once()
+        mock_read_table.assert_called_once_with(
+            mock_memory_map.return_value.__enter__.return_value
+        )
+
+    def test_execute_cache_hit_is_writable(self, tmp_path):
+        cache_file = tmp_path / "query.parquet"
+        pd.DataFrame({"a": [1, 2], "b": [1.0, 2.0]}).to_parquet(cache_file)
+
+        with patch("src.druidq.get_temp_file", return_value=cache_file):
+            df = execute("SELECT * FROM table")
 
-    @patch("src.druidq.pd.DataFrame.to_parquet")
-    @patch("src.druidq.pd.read_sql")
-    @patch("src.druidq.Path.exists")
-    @patch("src.druidq.create_engine")
+        df.loc[0, "a"] = 99
+        df.iloc[0, 1] = 7.0
+        assert df.loc[0, "a"] == 99
+        assert df.iloc[0, 1] == 7.0
+
+    @patch("pyarrow.parquet.read_table")
+    @patch("pyarrow.memory_map")
+    def test_execute_cache_hit_as_arrow(
+        self, mock_memory_map, mock_read_table
+    ):
+        mock_table = Mock()
+        mock_read_table.return_value = mock_table
+
+        result = execute("SELECT * FROM table", as_arrow=True)
+
+        assert result is mock_table
+        mock_read_table.assert_called_once()
+
+    @patch("pandas.DataFrame.to_parquet")
+    @patch("pandas.read_sql")
+    @patch("pyarrow.memory_map", side_effect=FileNotFoundError)
+    @patch("sqlalchemy.engine.create_engine")
     def test_execute_with_cache_miss(
-        self, mock_engine, mock_exists, mock_read_sql, mock_to_parquet
+        self,
+        mock_engine,
+        mock_memory_map,
+        mock_read_sql,
+        mock_to_parquet,
+        tmp_path,
     ):
-        mock_exists.return_value = False
         mock_df = pd.DataFrame({"id": [1], "name": ["fresh"]})
-        mock_read_sql.return_value = mock_df
+        mock_read_sql.return_value = iter([mock_df])
 
-        result = execute("SELECT * FROM table", no_cache=False)
+        cache_file = tmp_path / "query.parquet"
+        with patch("src.druidq.get_temp_file", return_value=cache_file):
+            result = execute("SELECT * FROM table", no_cache=False)
 
         assert result.equals(mock_df)
         mock_read_sql.assert_called_once()
         mock_to_parquet.assert_called_once()
+
+    @patch("pandas.read_sql")
+    @patch("sqlalchemy.engine.create_engine")
+    def test_execute_cache_write_is_atomic(
+        self, mock_engine, mock_read_sql, tmp_path
+    ):
+        cache_file = tmp_path / "query.parquet"
+        mock_df = pd.DataFrame({"id": [1], "name": ["fresh"]})
+        mock_read_sql.return_value = iter([mock_df])
+
+        with patch("src.druidq.get_temp_file", return_value=cache_file):
+            execute("SELECT * FROM table", no_cache=False)
+
+        assert cache_file.exists()
+        assert list(tmp_path.glob("*.tmp")) == []
+        assert pd.read_parquet(cache_file).equals(mock_df)
+
+    @patch("pandas.DataFrame.to_parquet", side_effect=OSError("disk full"))
+    @patch("pandas.read_sql")
+    @patch("sqlalchemy.engine.create_engine")
+    def test_execute_failed_cache_write_cleans_up(
+        self, mock_engine, mock_read_sql, mock_to_parquet, tmp_path
+    ):
+        cache_file = tmp_path / "query.parquet"
+        mock_df = pd.DataFrame({"id": [1], "name": ["fresh"]})
+        mock_read_sql.return_value = iter([mock_df])
+
+        with patch("src.druidq.get_temp_file", return_value=cache_file):
+            result = execute("SELECT * FROM table", no_cache=False)
+
+        assert result.equals(mock_df)
+        assert list(tmp_path.iterdir()) == []
+
+    @patch("pandas.DataFrame.to_parquet", side_effect=KeyboardInterrupt)
+    @patch("pandas.read_sql")
+    @patch("sqlalchemy.engine.create_engine")
+    def test_execute_interrupted_cache_write_cleans_up(
+        self, mock_engine, mock_read_sql, mock_to_parquet, tmp_path
+    ):
+        cache_file = tmp_path / "query.parquet"
+        mock_read_sql.return_value = iter([pd.DataFrame({"id": [1]})])
+
+        with patch("src.druidq.get_temp_file", return_value=cache_file):
+            with pytest.raises(KeyboardInterrupt):
+                execute("SELECT * FROM table", no_cache=False)
+
+        assert list(tmp_path.iterdir()) == []
+
+    @patch("src.druidq.os.replace")
+    @patch("pandas.read_sql")
+    @patch("sqlalchemy.engine.create_engine")
+    def test_cache_temp_names_are_unique(
+        self, mock_engine, mock_read_sql, mock_replace, tmp_path
+    ):
+        cache_file = tmp_path / "query.parquet"
+        mock_read_sql.side_effect = lambda *a, **k: iter(
+            [pd.DataFrame({"id": [1]})]
+        )
+        names = []
+
+        def record(self, path, **kwargs):
+            names.append(path)
+
+        with patch("pandas.DataFrame.to_parquet", record):
+            with patch("src.druidq.get_temp_file", return_value=cache_file):
+                execute("SELECT 1", no_cache=False)
+                execute("SELECT 1", no_cache=False)
+
+        assert len(set(names)) == 2
+        assert all(str(n).endswith(".parquet.tmp") for n in names)
+
+    @patch("sqlalchemy.engine.create_engine")
+    def test_get_engine_is_reused(self, mock_engine):
+        assert _get_engine("druid://a/") is _get_engine("druid://a/")
+        mock_engine.assert_called_once_with("druid://a/")
+
+    @patch("pandas.read_sql")
+    def test_read_sql_concatenates_chunks(self, mock_read_sql):
+        mock_read_sql.return_value = iter(
+            [pd.DataFrame({"id": [1, 2]}), pd.DataFrame({"id": [3]})]
+        )
+
+        engine = Mock()
+
+        result = read_sql("SELECT * FROM table", engine)
+
+        assert result.equals(pd.DataFrame({"id": [1, 2, 3]}))
+        engine.raw_connection.return_value.close.assert_called_once()
+
+    @patch("src.druidq.DRUIDQ_CHUNKSIZE", 3)
+    def test_read_sql_chunk_dtypes_match_single_read(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE t (a INTEGER, b REAL, c INTEGER)")
+        conn.executemany(
+            "INSERT INTO t VALUES (?, ?, ?)",
+            [
+                (None, None, 1),
+                (None, None, 2),
+                (None, None, 3),
+                (0, 1.5, None),
+                (1, None, 5),
+                (2, 2.5, 6),
+            ],
+        )
+        expected = pd.read_sql("SELECT * FROM t", conn)
+        engine = Mock()
+        engine.raw_connection.return_value = Mock(wraps=conn)
+
+        result = read_sql("SELECT * FROM t", engine)
+
+        assert result.dtypes.tolist() == expected.dtypes.tolist()
+        assert result.equals(expected)
+
+    @patch("src.druidq.DRUIDQ_CHUNKSIZE", 2)
+    def test_read_sql_chunk_dtypes_with_duplicate_columns(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE t (a INTEGER)")
+        conn.executemany("INSERT INTO t VALUES (?)", [(None,), (None,), (1,)])
+        query = "SELECT a, a FROM t"
+        expected = pd.read_sql(query, conn)
+        engine = Mock()
+        engine.raw_connection.return_value = Mock(wraps=conn)
+
+        result = read_sql(query, engine)
+
+        assert result.dtypes.tolist() == expected.dtypes.tolist()
+        assert result.equals(expected)
+
+
+class TestAppEval:
+    @pytest.mark.parametrize(
+        "code, expected",
+        [
+            ("print([pd.Timestamp(0).year for _ in range(1)])", "[1970]"),
+            ("f = lambda x: pd.Series(x).sum()\nprint(f([1, 2]))", "3"),
+            ("def g():\n    return pd.Series([1]).sum()\nprint(g())", "1"),
+        ],
+    )
+    @patch("src.druidq.execute")
+    def test_pd_visible_in_nested_scopes(
+        self, mock_execute, code, expected, capsys
+    ):
+        mock_execute.return_value = pd.DataFrame({"id": [1]})
+        argv = ["druidq", "SELECT 1", "-q", "-e", code]
+
+        with patch("sys.argv", argv):
+            app()
+
+        assert capsys.readouterr().out.strip() == expected